@@ -2,11 +2,15 @@ from __future__ import annotations
 
 from functools import lru_cache
 import hashlib
+import json
+import os
 from pathlib import Path
+import re
+import tempfile
 import time
 from uuid import uuid4
 
-from flask import Flask, Response, jsonify, render_template, request, url_for, send_file
+from flask import Flask, Response, g, jsonify, render_template, request, url_for, send_file
 
 from device_badge import render_device_badge_svg
 from device_store import DeviceStore
@@ -14,6 +18,12 @@ from session_store import SessionStore
 from roku_api import Roku, RokuECPError, discover_roku
 
 
+# App ids become part of a cache file name, so only plain ECP-style ids are accepted.
+_ICON_ID_RE = re.compile(r"[A-Za-z0-9._-]+")
+# Content types cached on disk; the extension records the type for later hits.
+_ICON_EXTS = {"image/png": ".png", "image/jpeg": ".jpg", "image/gif": ".gif", "image/webp": ".webp"}
+
+
 def create_app() -> Flask:
     app = Flask(__name__)
     data_root = Path(__file__).resolve().parent / "data"
@@ -21,15 +31,30 @@ def create_app() -> Flask:
     sessions = SessionStore(root_dir=data_root)
     badges_dir = data_root / "badges"
     badges_dir.mkdir(parents=True, exist_ok=True)
+    icons_dir = data_root / "icons"
+    icons_dir.mkdir(parents=True, exist_ok=True)
     lan_cache: dict[str, object] = {"ts": 0.0, "devices": []}
+    # ip -> (sig, mtime_ns) of the badge file last verified on disk.
+    _badge_sig_cache: dict[str, tuple[str, int]] = {}
+
+    # Page templates are static apart from their context; compile them once instead of per request.
+    if not app.debug:
+        app.jinja_env.auto_reload = False
+    tpl_index = app.jinja_env.get_template("index.html")
+    tpl_lan = app.jinja_env.get_template("lan_control.html")
+    tpl_channels = app.jinja_env.get_template("channels.html")
+    tpl_remote = app.jinja_env.get_template("remote.html")
+    tpl_user = app.jinja_env.get_template("user.html")
 
     BROWSER_ID_COOKIE = "zrocontrol_bid"
 
     def _get_browser_id() -> str:
-        bid = request.cookies.get(BROWSER_ID_COOKIE)
-        if bid:
-            return bid
-        return uuid4().hex
+        # Memoized per request so a cookie-less browser gets one id, matching the cookie we set.
+        if "bid" in g:
+            return g.bid
+        bid = request.cookies.get(BROWSER_ID_COOKIE) or uuid4().hex
+        g.bid = bid
+        return bid
 
     @app.after_request
     def _set_browser_id_cookie(resp):
@@ -39,13 +64,21 @@ def create_app() -> Flask:
         resp.set_cookie(BROWSER_ID_COOKIE, bid, max_age=60 * 60 * 24 * 365, httponly=True, samesite="Lax")
         return resp
 
+    # One client (and so one keep-alive pool) per device; latency-sensitive calls pass FAST_TIMEOUT_S.
+    FAST_TIMEOUT_S = (0.6, 2.0)
+
     @lru_cache(maxsize=64)
     def _roku(ip: str) -> Roku:
-        return Roku(ip, timeout_s=(1.0, 5.0))
+        return Roku(ip, timeout_s=(1.0, 5.0), use_fast_http=True)
 
-    @lru_cache(maxsize=64)
-    def _roku_fast(ip: str) -> Roku:
-        return Roku(ip, timeout_s=(0.6, 2.0))
+    def _stream_upstream(upstream) -> Response:
+        resp = Response(
+            upstream.iter_content(chunk_size=16384),
+            content_type=upstream.headers.get("Content-Type") or "image/png",
+            direct_passthrough=True,
+        )
+        resp.call_on_close(upstream.close)
+        return resp
 
     def _format_duration(sec: int) -> str:
         sec = max(0, int(sec))
@@ -60,7 +93,7 @@ def create_app() -> Flask:
 
     @app.get("/")
     def index():
-        return render_template("index.html")
+        return render_template(tpl_index)
 
     @app.get("/lan")
     def lan_control():
@@ -69,7 +102,7 @@ def create_app() -> Flask:
         cached = lan_cache.get("devices") if (now - float(lan_cache.get("ts") or 0.0)) < 60.0 else None
         if not cached:
             cached = store.list_known_devices()
-        return render_template("lan_control.html", devices=cached or [], timeout_s=timeout_s)
+        return render_template(tpl_lan, devices=cached or [], timeout_s=timeout_s)
 
     @app.get("/lan/devices")
     def lan_devices():
@@ -79,22 +112,27 @@ def create_app() -> Flask:
         except Exception:
             devices = []
 
+        records = [
+            {
+                "ip": d.ip,
+                "reachable": bool(d.name or d.model_name or d.model_number or d.serial_number or d.udn),
+                "name": d.name,
+                "model": d.model_name or d.model_number,
+            }
+            for d in devices
+        ]
+        cached_map = store.update_seen_many(records)
+
         result = []
-        for d in devices:
-            reachable = bool(d.name or d.model_name or d.model_number or d.serial_number or d.udn)
-            cached = store.update_seen(
-                d.ip,
-                reachable=reachable,
-                name=d.name,
-                model=d.model_name or d.model_number,
-            )
+        for d, rec in zip(devices, records):
+            cached = cached_map.get(d.ip) or {}
             result.append(
                 {
                     "name": (d.name or cached.get("device_name") or "Roku"),
                     "ip": d.ip,
                     "model": (d.model_name or d.model_number or cached.get("device_model") or ""),
                     "icon_url": url_for("api_device_badge", ip=d.ip),
-                    "reachable": reachable,
+                    "reachable": rec["reachable"],
                     "last_seen_ts": cached.get("last_seen_ts"),
                     "last_reachable_ts": cached.get("last_reachable_ts"),
                 }
@@ -109,32 +147,31 @@ def create_app() -> Flask:
         apps = []
         active = None
         error = None
+        recent = []
         if ip:
             try:
+                recent = list(store.load(ip).get("recent_channels") or [])
                 roku = _roku(ip)
                 apps = roku.get_apps()
                 active = roku.get_active_app()
-                state = store.load(ip)
             except (ValueError, RokuECPError) as exc:
                 error = str(exc)
 
         # Sort apps so most-recent launched appear first (no separate "recent" section).
-        recent = []
-        if ip:
-            try:
-                recent = list(store.load(ip).get("recent_channels") or [])
-            except Exception:
-                recent = []
         rank: dict[str, int] = {}
         for idx, ch in enumerate(recent):
             if ch.get("id"):
                 rank[str(ch["id"])] = idx
         if rank:
-            apps.sort(key=lambda a: (rank.get(str(a.get("id")), 10_000), (a.get("name") or "").lower()))
+            decorated = [
+                (rank.get(str(a.get("id")), 10_000), (a.get("name") or "").lower(), i, a) for i, a in enumerate(apps)
+            ]
+            decorated.sort()
+            apps = [a for _, _, _, a in decorated]
         else:
             apps.sort(key=lambda a: ((a.get("name") or "").lower()))
         return render_template(
-            "channels.html", ip=ip, apps=apps, active=active, error=error
+            tpl_channels, ip=ip, apps=apps, active=active, error=error
         )
 
     @app.get("/remote")
@@ -163,7 +200,7 @@ def create_app() -> Flask:
             except (ValueError, RokuECPError) as exc:
                 error = str(exc)
         return render_template(
-            "remote.html",
+            tpl_remote,
             ip=ip,
             info=info,
             error=error,
@@ -176,21 +213,21 @@ def create_app() -> Flask:
         error = None
         if ip:
             try:
-                _ = _roku_fast(ip).get_active_app()
+                _ = _roku(ip).get_active_app(timeout_s=FAST_TIMEOUT_S)
             except Exception:
                 pass
         else:
             error = "Select a device first (LAN tab)."
-        return render_template("user.html", ip=ip, error=error)
+        return render_template(tpl_user, ip=ip, error=error)
 
     @app.get("/api/device-info")
     def api_device_info():
         ip = request.args.get("ip", "")
         try:
-            device = _roku(ip).get_device_info()
+            device = _roku(ip).get_device_info_cached()
         except (ValueError, RokuECPError) as exc:
             return jsonify({"ok": False, "error": str(exc)}), 400
-        return jsonify({"ok": True, "device": device.__dict__})
+        return jsonify({"ok": True, "device": device._asdict()})
 
     @app.get("/api/apps")
     def api_apps():
@@ -199,13 +236,21 @@ def create_app() -> Flask:
             apps = _roku(ip).get_apps()
         except (ValueError, RokuECPError) as exc:
             return jsonify({"ok": False, "error": str(exc)}), 400
-        return jsonify({"ok": True, "apps": apps})
+        # Installed apps rarely change; let polling browsers revalidate instead of re-downloading.
+        etag = hashlib.blake2b(json.dumps(apps, sort_keys=True).encode("utf-8"), digest_size=8).hexdigest()
+        if request.if_none_match.contains(etag):
+            resp = Response(status=304)
+        else:
+            resp = jsonify({"ok": True, "apps": apps})
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = "private, max-age=5"
+        return resp
 
     @app.get("/api/active-app")
     def api_active_app():
         ip = request.args.get("ip", "")
         try:
-            active = _roku_fast(ip).get_active_app()
+            active = _roku(ip).get_active_app(timeout_s=FAST_TIMEOUT_S)
             store.note_active_app(ip, active)
             sessions.observe_active_app(ip, _get_browser_id(), active)
         except (ValueError, RokuECPError) as exc:
@@ -229,7 +274,7 @@ def create_app() -> Flask:
             return jsonify({"ok": False, "error": "Missing ip"}), 400
         if refresh:
             try:
-                active = _roku_fast(ip).get_active_app()
+                active = _roku(ip).get_active_app(timeout_s=FAST_TIMEOUT_S)
                 store.note_active_app(ip, active)
                 sessions.observe_active_app(ip, _get_browser_id(), active)
             except Exception:
@@ -241,7 +286,7 @@ def create_app() -> Flask:
     def api_reachable():
         ip = request.args.get("ip", "")
         try:
-            info = _roku_fast(ip).get_device_info()
+            info = _roku(ip).get_device_info(timeout_s=FAST_TIMEOUT_S)
             cached = store.update_seen(ip, reachable=True, name=info.name, model=info.model_name or info.model_number)
             return jsonify(
                 {
@@ -270,7 +315,7 @@ def create_app() -> Flask:
         ip = data.get("ip", "")
         key = data.get("key", "")
         try:
-            _roku_fast(ip).keypress(key)
+            _roku(ip).keypress(key, timeout_s=FAST_TIMEOUT_S)
         except (ValueError, RokuECPError) as exc:
             return jsonify({"ok": False, "error": str(exc)}), 400
         return jsonify({"ok": True})
@@ -290,36 +335,75 @@ def create_app() -> Flask:
 
     @app.get("/api/icon/<app_id>")
     def api_icon(app_id: str):
+        if not _ICON_ID_RE.fullmatch(app_id):
+            return Response(status=404)
         ip = request.args.get("ip", "")
         try:
-            content, content_type = _roku(ip).icon_bytes(app_id)
-        except (ValueError, RokuECPError):
+            roku = _roku(ip)
+        except ValueError:
             return Response(status=404)
-        return Response(content, content_type=content_type)
+        stem = f"{roku.ip.replace(':', '_')}_{app_id}"
+        for mimetype, ext in _ICON_EXTS.items():
+            icon_path = icons_dir / f"{stem}{ext}"
+            if icon_path.exists():
+                return send_file(icon_path, mimetype=mimetype, max_age=86400)
+        try:
+            content, content_type = roku.icon_bytes(app_id)
+        except RokuECPError:
+            return Response(status=404)
+        mimetype = content_type.split(";", 1)[0].strip().lower()
+        ext = _ICON_EXTS.get(mimetype)
+        if ext is None:
+            return Response(content, content_type=content_type)
+        icon_path = icons_dir / f"{stem}{ext}"
+        # Written beside the target and renamed in, so a concurrent hit never sees a partial icon.
+        tmp_path = None
+        try:
+            tmp_fd, tmp_path = tempfile.mkstemp(prefix=stem + ".", suffix=".tmp", dir=str(icons_dir))
+            with os.fdopen(tmp_fd, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, icon_path)
+        except OSError:
+            return Response(content, content_type=content_type)
+        finally:
+            if tmp_path is not None:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+        return send_file(icon_path, mimetype=mimetype, max_age=86400)
 
     @app.get("/api/device-icon")
     def api_device_icon():
         ip = request.args.get("ip", "")
         try:
-            content, content_type = _roku_fast(ip).device_icon_bytes()
+            upstream = _roku(ip).device_icon_stream(timeout_s=FAST_TIMEOUT_S)
         except (ValueError, RokuECPError):
             return Response(status=404)
-        return Response(content, content_type=content_type)
+        return _stream_upstream(upstream)
 
     @app.get("/api/device-badge")
     def api_device_badge():
         ip = request.args.get("ip", "")
         state = store.load(ip)
         sig_src = f"{ip}|{state.get('device_name') or ''}|{state.get('device_model') or ''}"
-        sig = hashlib.sha256(sig_src.encode("utf-8")).hexdigest()[:16]
+        sig = hashlib.blake2b(sig_src.encode("utf-8"), digest_size=8).hexdigest()
         badge_path = badges_dir / f"{ip}.svg"
         try:
-            if badge_path.exists():
-                head = badge_path.read_text(encoding="utf-8")[:120]
+            mtime_ns = badge_path.stat().st_mtime_ns
+        except OSError:
+            mtime_ns = None
+        if mtime_ns is not None:
+            if _badge_sig_cache.get(ip) == (sig, mtime_ns):
+                return send_file(badge_path, mimetype="image/svg+xml", max_age=86400)
+            try:
+                with badge_path.open("r", encoding="utf-8") as f:
+                    head = f.read(120)
                 if f"sig:{sig}" in head:
+                    _badge_sig_cache[ip] = (sig, mtime_ns)
                     return send_file(badge_path, mimetype="image/svg+xml", max_age=86400)
-        except Exception:
-            pass
+            except Exception:
+                pass
 
         svg = render_device_badge_svg(
             ip=ip,
@@ -330,6 +414,7 @@ def create_app() -> Flask:
         svg = f"<!-- sig:{sig} -->\n{svg}"
         try:
             badge_path.write_text(svg, encoding="utf-8")
+            _badge_sig_cache[ip] = (sig, badge_path.stat().st_mtime_ns)
         except Exception:
             return Response(svg, content_type="image/svg+xml", headers={"Cache-Control": "public, max-age=3600"})
         return send_file(badge_path, mimetype="image/svg+xml", max_age=86400)
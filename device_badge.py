@@ -2,72 +2,22 @@ from __future__ import annotations
 
 import re
 import typing as t
+from functools import lru_cache
 
+# Common patterns: `32" TCL Roku TV`, `55 TCL Roku TV`, `65" Hisense Roku TV`
+_TV_RE = re.compile(r"(?P<size>\d{2,3})\s*(?:[\"”]|-inch|in\b)?\s+(?P<brand>[A-Za-z0-9]+)")
 
-def _escape(s: str) -> str:
-    return (
-        s.replace("&", "&amp;")
-        .replace("<", "&lt;")
-        .replace(">", "&gt;")
-        .replace('"', "&quot;")
-        .replace("'", "&#039;")
-    )
 
-
-def parse_tv_brand_and_size(device_name: str | None, model_name: str | None) -> tuple[t.Optional[str], t.Optional[str]]:
-    text = (device_name or "").strip()
-    if not text:
-        text = (model_name or "").strip()
-    if not text:
-        return None, None
-
-    # Common patterns: `32" TCL Roku TV`, `55 TCL Roku TV`, `65" Hisense Roku TV`
-    m = re.search(r"(?P<size>\d{2,3})\s*(?:[\"”]|-inch|in\b)?\s+(?P<brand>[A-Za-z0-9]+)", text)
-    if not m:
-        return None, None
-    size = m.group("size")
-    brand = m.group("brand")
-    return brand, size
+_ESCAPE_RE = re.compile(r"[&<>\"']")
+_ESCAPE_MAP = {"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#039;"}
 
 
-def render_device_badge_svg(
-    *,
-    ip: str,
-    device_name: str | None,
-    model_name: str | None,
-    model_number: str | None = None,
-) -> str:
-    brand, size = parse_tv_brand_and_size(device_name, model_name)
-    title = (device_name or "").strip() or "Roku"
-    subtitle = (model_name or "").strip() or ""
-    model_no = (model_number or "").strip()
+def _escape(s: str) -> str:
+    return _ESCAPE_RE.sub(lambda m: _ESCAPE_MAP[m.group(0)], s)
 
-    big = ""
-    small = ""
-    if size and brand:
-        big = f'{size}" {brand}'
-        small = "Roku TV"
-    elif subtitle:
-        big = subtitle
-        small = "Roku"
-    else:
-        big = title
-        small = "Roku"
-
-    lines = []
-    lines.append(f"<text x='24' y='76' font-size='44' font-weight='800' fill='#F4F2FF'>{_escape(big)}</text>")
-    lines.append(
-        f"<text x='24' y='116' font-size='20' font-weight='700' fill='rgba(244,242,255,0.72)'>{_escape(small)}</text>"
-    )
-    if model_no:
-        lines.append(
-            f"<text x='24' y='150' font-size='16' font-weight='600' fill='rgba(244,242,255,0.55)'>Model { _escape(model_no) }</text>"
-        )
-    lines.append(
-        f"<text x='24' y='232' font-size='14' font-family='ui-monospace, SFMono-Regular, Menlo, Monaco, Consolas, monospace' fill='rgba(244,242,255,0.55)'>{_escape(ip)}</text>"
-    )
 
-    svg = f"""<svg xmlns="http://www.w3.org/2000/svg" width="256" height="256" viewBox="0 0 256 256">
+# Static frame of the badge; only the <text> lines in between depend on the device.
+_SVG_PREFIX = """<svg xmlns="http://www.w3.org/2000/svg" width="256" height="256" viewBox="0 0 256 256">
   <defs>
     <linearGradient id="g" x1="0" y1="0" x2="1" y2="1">
       <stop offset="0" stop-color="#ff3bd4"/>
@@ -87,7 +37,62 @@ def render_device_badge_svg(
   <rect x="12" y="12" width="232" height="232" rx="44" fill="none" stroke="rgba(255,255,255,0.10)"/>
   <circle cx="214" cy="46" r="10" fill="rgba(255,59,212,0.75)"/>
   <circle cx="214" cy="46" r="22" fill="rgba(255,59,212,0.12)"/>
-  {''.join(lines)}
-</svg>"""
-    return svg
+  """
+_SVG_SUFFIX = "\n</svg>"
+
 
+def parse_tv_brand_and_size(device_name: str | None, model_name: str | None) -> tuple[t.Optional[str], t.Optional[str]]:
+    text = (device_name or "").strip()
+    if not text:
+        text = (model_name or "").strip()
+    if not text:
+        return None, None
+
+    m = _TV_RE.search(text)
+    if not m:
+        return None, None
+    size = m.group("size")
+    brand = m.group("brand")
+    return brand, size
+
+
+def _badge_labels(device_name: str | None, model_name: str | None) -> tuple[str, str]:
+    brand, size = parse_tv_brand_and_size(device_name, model_name)
+    if size and brand:
+        return f'{size}" {brand}', "Roku TV"
+    subtitle = (model_name or "").strip()
+    if subtitle:
+        return subtitle, "Roku"
+    return (device_name or "").strip() or "Roku", "Roku"
+
+
+@lru_cache(maxsize=256)
+def _render_cached(ip: str, device_name: str | None, model_name: str | None, model_number: str | None) -> str:
+    big, small = _badge_labels(device_name, model_name)
+    model_no = (model_number or "").strip()
+
+    model_line = (
+        f"<text x='24' y='150' font-size='16' font-weight='600' fill='rgba(244,242,255,0.55)'>Model { _escape(model_no) }</text>"
+        if model_no
+        else ""
+    )
+    parts = [
+        _SVG_PREFIX,
+        f"<text x='24' y='76' font-size='44' font-weight='800' fill='#F4F2FF'>{_escape(big)}</text>",
+        f"<text x='24' y='116' font-size='20' font-weight='700' fill='rgba(244,242,255,0.72)'>{_escape(small)}</text>",
+        model_line,
+        f"<text x='24' y='232' font-size='14' font-family='ui-monospace, SFMono-Regular, Menlo, Monaco, Consolas, monospace' fill='rgba(244,242,255,0.55)'>{_escape(ip)}</text>",
+        _SVG_SUFFIX,
+    ]
+    return "".join(parts)
+
+
+def render_device_badge_svg(
+    *,
+    ip: str,
+    device_name: str | None,
+    model_name: str | None,
+    model_number: str | None = None,
+) -> str:
+    # Pure function of its inputs; repeat renders for the same device are served from the LRU.
+    return _render_cached(ip, device_name, model_name, model_number)
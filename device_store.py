@@ -1,13 +1,21 @@
 from __future__ import annotations
 
-import json
-import os
-import tempfile
+import datetime
+import sqlite3
 import time
 import typing as t
 from dataclasses import dataclass
 from pathlib import Path
 
+from state_db import dumps, loads, open_state_db
+
+
+# update_seen only rewrites a device row this often when nothing but timestamps changed.
+SEEN_THROTTLE_SEC = 30.0
+# Repeat observations of the same active/recent channel within this window are not rewritten.
+BUMP_THROTTLE_SEC = 30.0
+_SEEN_TS_KEYS = frozenset({"last_seen_ts", "last_reachable_ts"})
+
 
 def _now_ts() -> float:
     return time.time()
@@ -17,8 +25,80 @@ def _iso(ts: float) -> str:
     return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(ts))
 
 
-def _safe_device_key(ip: str) -> str:
-    return ip.replace(":", "_")
+def _parse_iso(s: str) -> float:
+    # Naive local time, matching what `_iso` writes.
+    return datetime.datetime.fromisoformat(s).timestamp()
+
+
+def _within(stamp: t.Any, ts: float, window_s: float) -> bool:
+    if window_s <= 0 or not stamp:
+        return False
+    try:
+        return (ts - _parse_iso(stamp)) < window_s
+    except Exception:
+        return False
+
+
+def _empty_state(ip: str) -> dict[str, t.Any]:
+    return {
+        "device_ip": ip,
+        "recent_channels": [],
+        "last_active_app": None,
+        "last_active_seen_ts": None,
+        "last_seen_ts": None,
+        "last_reachable_ts": None,
+        "device_name": None,
+        "device_model": None,
+    }
+
+
+def _save_row(conn: sqlite3.Connection, ip: str, state: dict[str, t.Any]) -> None:
+    conn.execute(
+        "INSERT OR REPLACE INTO devices (ip, state, device_name, device_model, last_seen_ts, last_reachable_ts) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (
+            ip,
+            dumps(state),
+            state.get("device_name"),
+            state.get("device_model"),
+            state.get("last_seen_ts"),
+            state.get("last_reachable_ts"),
+        ),
+    )
+
+
+def _import_json_state(conn: sqlite3.Connection, state: dict[str, t.Any]) -> None:
+    _save_row(conn, str(state["device_ip"]), state)
+
+
+def _apply_seen(
+    state: dict[str, t.Any],
+    stamp: str,
+    *,
+    reachable: bool | None,
+    name: str | None,
+    model: str | None,
+) -> None:
+    state["last_seen_ts"] = stamp
+    if reachable is True:
+        state["last_reachable_ts"] = stamp
+    if name:
+        state["device_name"] = name
+    if model:
+        state["device_model"] = model
+
+
+def _bump_recent_in_state(
+    state: dict[str, t.Any],
+    app_id: str,
+    app_name: str | None,
+    stamp: str,
+) -> list[dict[str, t.Any]]:
+    name = (app_name or "").strip() or app_id
+    recent: list[dict[str, t.Any]] = [x for x in (state.get("recent_channels") or []) if x.get("id") != app_id]
+    recent.insert(0, {"id": app_id, "name": name, "last_opened": stamp})
+    state["recent_channels"] = recent[:12]
+    return state["recent_channels"]
 
 
 @dataclass
@@ -29,57 +109,35 @@ class RecentChannel:
 
 
 class DeviceStore:
-    def __init__(self, root_dir: Path):
+    def __init__(
+        self,
+        root_dir: Path,
+        *,
+        seen_throttle_s: float = SEEN_THROTTLE_SEC,
+        bump_throttle_s: float = BUMP_THROTTLE_SEC,
+    ):
         self.root_dir = root_dir
-        self.devices_dir = self.root_dir / "devices"
-        self.devices_dir.mkdir(parents=True, exist_ok=True)
-
-    def _path_for_ip(self, ip: str) -> Path:
-        return self.devices_dir / f"{_safe_device_key(ip)}.json"
+        self.seen_throttle_s = seen_throttle_s
+        self.bump_throttle_s = bump_throttle_s
+        self._db = open_state_db(root_dir)
+        self._db.migrate_json_dir("migrated_json_devices", self.root_dir / "devices", _import_json_state)
 
     def load(self, ip: str) -> dict[str, t.Any]:
-        path = self._path_for_ip(ip)
-        if not path.exists():
-            return {
-                "device_ip": ip,
-                "recent_channels": [],
-                "last_active_app": None,
-                "last_active_seen_ts": None,
-                "last_seen_ts": None,
-                "last_reachable_ts": None,
-                "device_name": None,
-                "device_model": None,
-            }
+        with self._db.connection() as conn:
+            row = conn.execute("SELECT state FROM devices WHERE ip = ?", (ip,)).fetchone()
+        if row is None:
+            return _empty_state(ip)
         try:
-            return json.loads(path.read_text(encoding="utf-8"))
+            return loads(row[0])
         except Exception:
-            return {
-                "device_ip": ip,
-                "recent_channels": [],
-                "last_active_app": None,
-                "last_active_seen_ts": None,
-                "last_seen_ts": None,
-                "last_reachable_ts": None,
-                "device_name": None,
-                "device_model": None,
-            }
+            return _empty_state(ip)
 
     def save(self, ip: str, state: dict[str, t.Any]) -> None:
-        path = self._path_for_ip(ip)
-        state = dict(state)
-        state["device_ip"] = ip
-
-        tmp_fd, tmp_path = tempfile.mkstemp(prefix=path.stem + ".", suffix=".tmp", dir=str(self.devices_dir))
-        try:
-            with os.fdopen(tmp_fd, "w", encoding="utf-8", newline="\n") as f:
-                json.dump(state, f, indent=2, sort_keys=True)
-                f.write("\n")
-            os.replace(tmp_path, path)
-        finally:
-            try:
-                os.unlink(tmp_path)
-            except OSError:
-                pass
+        # `state` is the caller's own loaded dict and is stamped in place rather than copied.
+        if state.get("device_ip") != ip:
+            state["device_ip"] = ip
+        with self._db.transaction() as conn:
+            _save_row(conn, ip, state)
 
     def update_seen(
         self,
@@ -90,63 +148,95 @@ class DeviceStore:
         model: str | None = None,
     ) -> dict[str, t.Any]:
         ts = _now_ts()
-        state = self.load(ip)
-        state["last_seen_ts"] = _iso(ts)
-        if reachable is True:
-            state["last_reachable_ts"] = _iso(ts)
-        if name:
-            state["device_name"] = name
-        if model:
-            state["device_model"] = model
-        self.save(ip, state)
+        with self._db.transaction():
+            state = self.load(ip)
+            before = dict(state)
+            _apply_seen(state, _iso(ts), reachable=reachable, name=name, model=model)
+            if self._seen_is_redundant(before, state, ts):
+                return before
+            self.save(ip, state)
         return state
 
+    def update_seen_many(self, records: list[dict[str, t.Any]]) -> dict[str, dict[str, t.Any]]:
+        # Each record carries `ip` plus the optional `reachable`/`name`/`model` of `update_seen`.
+        ts = _now_ts()
+        stamp = _iso(ts)
+        originals: dict[str, dict[str, t.Any]] = {}
+        states: dict[str, dict[str, t.Any]] = {}
+        # One transaction, so the whole batch costs a single commit.
+        with self._db.transaction():
+            for rec in records:
+                ip = rec.get("ip")
+                if not ip:
+                    continue
+                state = states.get(ip)
+                if state is None:
+                    state = self.load(ip)
+                    originals[ip] = dict(state)
+                _apply_seen(
+                    state,
+                    stamp,
+                    reachable=rec.get("reachable"),
+                    name=rec.get("name"),
+                    model=rec.get("model"),
+                )
+                states[ip] = state
+            for ip, state in states.items():
+                if self._seen_is_redundant(originals[ip], state, ts):
+                    states[ip] = originals[ip]
+                    continue
+                self.save(ip, state)
+        return states
+
+    def _seen_is_redundant(self, before: dict[str, t.Any], after: dict[str, t.Any], ts: float) -> bool:
+        # Skip rewriting the row when only the seen/reachable timestamps would move, and the
+        # stored ones are still recent. A first successful reach is always recorded.
+        if self.seen_throttle_s <= 0 or not before.get("last_seen_ts"):
+            return False
+        if after.get("last_reachable_ts") and not before.get("last_reachable_ts"):
+            return False
+        for key in after.keys() | before.keys():
+            if key not in _SEEN_TS_KEYS and after.get(key) != before.get(key):
+                return False
+        return _within(before["last_seen_ts"], ts, self.seen_throttle_s)
+
     def bump_recent(self, ip: str, app_id: str, app_name: str | None) -> list[dict[str, t.Any]]:
         if not app_id:
             return []
         ts = _now_ts()
-        state = self.load(ip)
-        name = (app_name or "").strip() or app_id
-
-        recent: list[dict[str, t.Any]] = list(state.get("recent_channels") or [])
-        recent = [x for x in recent if x.get("id") != app_id]
-        recent.insert(0, {"id": app_id, "name": name, "last_opened": _iso(ts)})
-        state["recent_channels"] = recent[:12]
-        self.save(ip, state)
-        return state["recent_channels"]
+        with self._db.transaction():
+            state = self.load(ip)
+            recent = list(state.get("recent_channels") or [])
+            if recent and recent[0].get("id") == app_id and _within(recent[0].get("last_opened"), ts, self.bump_throttle_s):
+                return recent
+            recent = _bump_recent_in_state(state, app_id, app_name, _iso(ts))
+            self.save(ip, state)
+        return recent
 
     def note_active_app(self, ip: str, active_app: dict[str, t.Any] | None) -> None:
         ts = _now_ts()
-        state = self.load(ip)
-        state["last_active_seen_ts"] = _iso(ts)
-        state["last_active_app"] = active_app
-        self.save(ip, state)
-
-        if active_app and active_app.get("id"):
-            self.bump_recent(ip, str(active_app.get("id")), t.cast(t.Optional[str], active_app.get("name")))
+        stamp = _iso(ts)
+        with self._db.transaction():
+            state = self.load(ip)
+            # Still on the same channel as the last recorded poll: nothing worth rewriting yet.
+            if state.get("last_active_app") == active_app and _within(
+                state.get("last_active_seen_ts"), ts, self.bump_throttle_s
+            ):
+                return
+            state["last_active_seen_ts"] = stamp
+            state["last_active_app"] = active_app
+            if active_app and active_app.get("id"):
+                app_name = t.cast(t.Optional[str], active_app.get("name"))
+                _bump_recent_in_state(state, str(active_app.get("id")), app_name, stamp)
+            self.save(ip, state)
 
     def list_known_devices(self) -> list[dict[str, t.Any]]:
-        devices: list[dict[str, t.Any]] = []
-        try:
-            paths = sorted(self.devices_dir.glob("*.json"), key=lambda p: p.name)
-        except Exception:
-            return devices
-        for p in paths:
-            try:
-                state = json.loads(p.read_text(encoding="utf-8"))
-            except Exception:
-                continue
-            ip = state.get("device_ip")
-            if not ip:
-                continue
-            devices.append(
-                {
-                    "ip": ip,
-                    "name": state.get("device_name"),
-                    "model": state.get("device_model"),
-                    "last_seen_ts": state.get("last_seen_ts"),
-                    "last_reachable_ts": state.get("last_reachable_ts"),
-                }
-            )
-        devices.sort(key=lambda d: (d.get("last_seen_ts") or "", d.get("ip") or ""), reverse=True)
-        return devices
+        with self._db.connection() as conn:
+            rows = conn.execute(
+                "SELECT ip, device_name, device_model, last_seen_ts, last_reachable_ts FROM devices "
+                "ORDER BY last_seen_ts DESC, ip DESC"
+            ).fetchall()
+        return [
+            {"ip": ip, "name": name, "model": model, "last_seen_ts": last_seen, "last_reachable_ts": last_reachable}
+            for ip, name, model, last_seen, last_reachable in rows
+        ]
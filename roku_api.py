@@ -1,17 +1,29 @@
 from __future__ import annotations
 
-import dataclasses
+import http.client
+import io
 import ipaddress
+import re
+import selectors
 import socket
+import threading
 import time
 import typing as t
-import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from urllib.parse import urlencode
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
+try:
+    from lxml import etree as ET
+except ImportError:  # pragma: no cover - lxml is optional
+    import xml.etree.ElementTree as ET
 
-@dataclasses.dataclass(frozen=True)
-class RokuDevice:
+
+class RokuDevice(t.NamedTuple):
     ip: str
     name: t.Optional[str] = None
     model_name: t.Optional[str] = None
@@ -24,6 +36,11 @@ class RokuECPError(RuntimeError):
     pass
 
 
+_DEVICE_INFO_TAGS = frozenset(
+    {"user-device-name", "friendly-device-name", "model-name", "model-number", "serial-number", "udn"}
+)
+
+
 def _xml_text(elem: t.Optional[ET.Element]) -> t.Optional[str]:
     if elem is None:
         return None
@@ -38,6 +55,21 @@ def _parse_xml(xml_bytes: bytes) -> ET.Element:
         raise RokuECPError("Failed to parse Roku XML response") from exc
 
 
+# Device info only changes on rename or firmware update; shared by every Roku client.
+_devinfo_cache: dict[str, tuple[float, RokuDevice]] = {}
+_devinfo_lock = threading.Lock()
+
+
+def _iter_xml_elements(xml_bytes: bytes, tag: str) -> t.Iterator[ET.Element]:
+    try:
+        for _event, elem in ET.iterparse(io.BytesIO(xml_bytes), events=("end",)):
+            if elem.tag == tag:
+                yield elem
+    except ET.ParseError as exc:
+        raise RokuECPError("Failed to parse Roku XML response") from exc
+
+
+@lru_cache(maxsize=256)
 def _safe_ip(ip: str) -> str:
     try:
         return str(ipaddress.ip_address(ip))
@@ -45,93 +77,213 @@ def _safe_ip(ip: str) -> str:
         raise ValueError(f"Invalid IP address: {ip}") from exc
 
 
+Timeout = t.Union[float, tuple[float, float]]
+
+
+class _ECPResponse(t.NamedTuple):
+    status_code: int
+    headers: t.Mapping[str, str]
+    content: bytes
+
+
+def _split_timeout(timeout_s: Timeout) -> tuple[float, float]:
+    # (connect, read), the same shape requests accepts.
+    if isinstance(timeout_s, tuple):
+        return timeout_s
+    return timeout_s, timeout_s
+
+
+# Idle fast-path connections kept per device; Werkzeug serves each client on its own thread,
+# so the pool is shared across threads rather than held per thread.
+_FAST_POOL_MAXSIZE = 4
+
+
 class Roku:
-    def __init__(self, ip: str, timeout_s: t.Union[float, tuple[float, float]] = 3.0):
+    def __init__(self, ip: str, timeout_s: Timeout = 3.0, *, use_fast_http: bool = False):
         self.ip = _safe_ip(ip)
         self.base = f"http://{self.ip}:8060"
         self._timeout_s = timeout_s
+        # ECP is plain HTTP/1.1 (no auth, redirects or cookies), so non-streaming calls can skip
+        # the requests stack and reuse raw keep-alive connections from a small shared pool.
+        self._use_fast_http = use_fast_http
+        self._pool: list[http.client.HTTPConnection] = []
+        self._pool_lock = threading.Lock()
         self._session = requests.Session()
-
-    def _get(self, path: str) -> requests.Response:
+        # ECP bursts (icons, polling, keypresses) all hit the same host; keep the sockets warm.
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=Retry(total=0, connect=0, read=0))
+        self._session.mount("http://", adapter)
+        self._session.headers["Connection"] = "keep-alive"
+        # ECP responses are tiny; compression only costs CPU.
+        self._session.headers["Accept-Encoding"] = "identity"
+
+    def _checkout_conn(self) -> t.Optional[http.client.HTTPConnection]:
+        with self._pool_lock:
+            return self._pool.pop() if self._pool else None
+
+    def _checkin_conn(self, conn: http.client.HTTPConnection) -> None:
+        with self._pool_lock:
+            if len(self._pool) < _FAST_POOL_MAXSIZE:
+                self._pool.append(conn)
+                return
+        conn.close()
+
+    def _fast_request(
+        self,
+        method: str,
+        path: str,
+        data: t.Optional[dict[str, str]],
+        timeout_s: t.Optional[Timeout],
+    ) -> _ECPResponse:
+        url = f"{self.base}{path}"
+        connect_timeout, read_timeout = _split_timeout(self._timeout_s if timeout_s is None else timeout_s)
+        body = urlencode(data) if data else None
+        headers = {"Content-Type": "application/x-www-form-urlencoded"} if body else {}
+        for attempt in range(2):
+            # A retry always dials a fresh socket rather than trying another pooled one.
+            conn = self._checkout_conn() if attempt == 0 else None
+            reused = conn is not None
+            if conn is None:
+                conn = http.client.HTTPConnection(self.ip, 8060, timeout=connect_timeout)
+            try:
+                if conn.sock is None:
+                    conn.timeout = connect_timeout
+                    conn.connect()
+                conn.sock.settimeout(read_timeout)
+                conn.request(method, path, body=body, headers=headers)
+                resp = conn.getresponse()
+                content = resp.read()
+            except (http.client.HTTPException, OSError) as exc:
+                conn.close()
+                # The Roku may have dropped an idle keep-alive socket; retry once on a fresh one.
+                stale = isinstance(exc, (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError))
+                if attempt == 0 and reused and stale:
+                    continue
+                raise RokuECPError(f"Roku {method} failed: {url}") from exc
+            if resp.will_close:
+                conn.close()
+            else:
+                self._checkin_conn(conn)
+            if resp.status >= 400:
+                raise RokuECPError(f"Roku {method} {url} returned {resp.status}")
+            return _ECPResponse(resp.status, resp.headers, content)
+        raise RokuECPError(f"Roku {method} failed: {url}")
+
+    def _get(
+        self,
+        path: str,
+        timeout_s: t.Optional[Timeout] = None,
+        stream: bool = False,
+    ) -> t.Union[requests.Response, _ECPResponse]:
+        if self._use_fast_http and not stream:
+            return self._fast_request("GET", path, None, timeout_s)
         url = f"{self.base}{path}"
         try:
-            resp = self._session.get(url, timeout=self._timeout_s)
+            resp = self._session.get(url, timeout=self._timeout_s if timeout_s is None else timeout_s, stream=stream)
             resp.raise_for_status()
             return resp
         except requests.RequestException as exc:
             raise RokuECPError(f"Roku GET failed: {url}") from exc
 
-    def _post(self, path: str, data: t.Optional[dict[str, str]] = None) -> None:
+    def _post(
+        self,
+        path: str,
+        data: t.Optional[dict[str, str]] = None,
+        timeout_s: t.Optional[Timeout] = None,
+    ) -> None:
+        if self._use_fast_http:
+            self._fast_request("POST", path, data, timeout_s)
+            return
         url = f"{self.base}{path}"
         try:
-            resp = self._session.post(url, data=data, timeout=self._timeout_s)
-            resp.raise_for_status()
+            resp = self._session.post(url, data=data, timeout=self._timeout_s if timeout_s is None else timeout_s)
         except requests.RequestException as exc:
             raise RokuECPError(f"Roku POST failed: {url}") from exc
+        if resp.status_code >= 400:
+            raise RokuECPError(f"Roku POST {url} returned {resp.status_code}")
 
-    def get_device_info(self) -> RokuDevice:
-        resp = self._get("/query/device-info")
-        root = _parse_xml(resp.content)
-        return RokuDevice(
+    def get_device_info(self, timeout_s: t.Optional[Timeout] = None) -> RokuDevice:
+        try:
+            resp = self._get("/query/device-info", timeout_s=timeout_s)
+            root = _parse_xml(resp.content)
+        except RokuECPError:
+            # Stop serving a cached entry for a device that no longer answers.
+            with _devinfo_lock:
+                _devinfo_cache.pop(self.ip, None)
+            raise
+        fields: dict[str, t.Optional[str]] = {}
+        for child in root:
+            if child.tag in _DEVICE_INFO_TAGS and child.tag not in fields:
+                fields[child.tag] = _xml_text(child)
+        device = RokuDevice(
             ip=self.ip,
-            name=_xml_text(root.find("user-device-name")) or _xml_text(root.find("friendly-device-name")),
-            model_name=_xml_text(root.find("model-name")),
-            model_number=_xml_text(root.find("model-number")),
-            serial_number=_xml_text(root.find("serial-number")),
-            udn=_xml_text(root.find("udn")),
+            name=fields.get("user-device-name") or fields.get("friendly-device-name"),
+            model_name=fields.get("model-name"),
+            model_number=fields.get("model-number"),
+            serial_number=fields.get("serial-number"),
+            udn=fields.get("udn"),
         )
-
-    def get_apps(self) -> list[dict[str, t.Any]]:
-        resp = self._get("/query/apps")
-        root = _parse_xml(resp.content)
+        with _devinfo_lock:
+            _devinfo_cache[self.ip] = (time.monotonic(), device)
+        return device
+
+    def get_device_info_cached(self, ttl: float = 30.0, timeout_s: t.Optional[Timeout] = None) -> RokuDevice:
+        with _devinfo_lock:
+            hit = _devinfo_cache.get(self.ip)
+        if hit is not None and (time.monotonic() - hit[0]) < ttl:
+            return hit[1]
+        return self.get_device_info(timeout_s=timeout_s)
+
+    def get_apps(self, timeout_s: t.Optional[Timeout] = None) -> list[dict[str, t.Any]]:
+        resp = self._get("/query/apps", timeout_s=timeout_s)
         apps: list[dict[str, t.Any]] = []
-        for app_elem in root.findall("app"):
-            app_id = app_elem.attrib.get("id")
+        for app_elem in _iter_xml_elements(resp.content, "app"):
+            attrib = dict(app_elem.attrib)
+            name = (app_elem.text or "").strip()
+            app_elem.clear()
+            app_id = attrib.get("id")
             if not app_id:
                 continue
             apps.append(
                 {
                     "id": app_id,
-                    "type": app_elem.attrib.get("type"),
-                    "version": app_elem.attrib.get("version"),
-                    "name": (app_elem.text or "").strip(),
+                    "type": attrib.get("type"),
+                    "version": attrib.get("version"),
+                    "name": name,
                 }
             )
         apps.sort(key=lambda a: (a.get("name") or "").lower())
         return apps
 
-    def get_active_app(self) -> t.Optional[dict[str, t.Any]]:
-        resp = self._get("/query/active-app")
+    def get_active_app(self, timeout_s: t.Optional[Timeout] = None) -> t.Optional[dict[str, t.Any]]:
+        resp = self._get("/query/active-app", timeout_s=timeout_s)
         root = _parse_xml(resp.content)
         app = root.find("app")
         if app is None:
             return None
         return {"id": app.attrib.get("id"), "name": (app.text or "").strip()}
 
-    def keypress(self, key: str) -> None:
-        self._post(f"/keypress/{key}")
+    def keypress(self, key: str, timeout_s: t.Optional[Timeout] = None) -> None:
+        self._post(f"/keypress/{key}", timeout_s=timeout_s)
 
-    def keydown(self, key: str) -> None:
-        self._post(f"/keydown/{key}")
+    def keydown(self, key: str, timeout_s: t.Optional[Timeout] = None) -> None:
+        self._post(f"/keydown/{key}", timeout_s=timeout_s)
 
-    def keyup(self, key: str) -> None:
-        self._post(f"/keyup/{key}")
+    def keyup(self, key: str, timeout_s: t.Optional[Timeout] = None) -> None:
+        self._post(f"/keyup/{key}", timeout_s=timeout_s)
 
-    def launch_app(self, app_id: str) -> None:
-        self._post(f"/launch/{app_id}")
+    def launch_app(self, app_id: str, timeout_s: t.Optional[Timeout] = None) -> None:
+        self._post(f"/launch/{app_id}", timeout_s=timeout_s)
 
-    def icon_bytes(self, app_id: str) -> tuple[bytes, str]:
-        resp = self._get(f"/query/icon/{app_id}")
+    def icon_bytes(self, app_id: str, timeout_s: t.Optional[Timeout] = None) -> tuple[bytes, str]:
+        resp = self._get(f"/query/icon/{app_id}", timeout_s=timeout_s)
         content_type = resp.headers.get("Content-Type") or "image/png"
         return resp.content, content_type
 
-    def device_icon_bytes(self) -> tuple[bytes, str]:
-        resp = self._get("/query/icon/0")
-        content_type = resp.headers.get("Content-Type") or "image/png"
-        return resp.content, content_type
+    def device_icon_stream(self, timeout_s: t.Optional[Timeout] = None) -> requests.Response:
+        return t.cast(requests.Response, self._get("/query/icon/0", timeout_s=timeout_s, stream=True))
 
 
-def _ssdp_msearch_payload(mx: int) -> bytes:
+def _build_msearch_payload(mx: int) -> bytes:
     lines = [
         "M-SEARCH * HTTP/1.1",
         "HOST: 239.255.255.250:1900",
@@ -141,18 +293,30 @@ def _ssdp_msearch_payload(mx: int) -> bytes:
         "",
         "",
     ]
-    return "\r\n".join(lines).encode("utf-8")
+    return "\r\n".join(lines).encode("ascii")
+
+
+_SSDP_PAYLOADS = {mx: _build_msearch_payload(mx) for mx in range(1, 6)}
+
+
+_SSDP_ADDR = ("239.255.255.250", 1900)
+_SSDP_SEND_COUNT = 3
+_SSDP_RESEND_INTERVAL_S = 0.08
+
+
+def _ssdp_msearch_payload(mx: int) -> bytes:
+    return _SSDP_PAYLOADS.get(mx) or _build_msearch_payload(mx)
+
+
+_SSDP_HDR_RE = re.compile(rb"(?im)^(st|location|usn)[ \t]*:[ \t]*(.*?)[ \t]*\r?$")
 
 
 def _parse_ssdp_response(msg: bytes) -> dict[str, str]:
-    text = msg.decode("utf-8", errors="ignore")
-    headers: dict[str, str] = {}
-    for line in text.splitlines()[1:]:
-        if not line or ":" not in line:
-            continue
-        k, v = line.split(":", 1)
-        headers[k.strip().lower()] = v.strip()
-    return headers
+    # Only the headers discovery looks at are extracted, straight from the raw datagram.
+    return {
+        m.group(1).lower().decode("ascii"): m.group(2).decode("ascii", errors="ignore")
+        for m in _SSDP_HDR_RE.finditer(msg)
+    }
 
 
 def discover_roku(
@@ -167,38 +331,67 @@ def discover_roku(
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.settimeout(0.25)
+    sock.setblocking(False)
+    sel = selectors.DefaultSelector()
 
     try:
-        sock.sendto(payload, ("239.255.255.250", 1900))
+        sel.register(sock, selectors.EVENT_READ)
+        sock.sendto(payload, _SSDP_ADDR)
+        # Multicast replies get dropped on busy LANs; repeat the search early in the window.
+        sends = 1
+        next_send_ts = time.monotonic() + _SSDP_RESEND_INTERVAL_S
         ips: set[str] = set()
-        while time.monotonic() < deadline:
+        while True:
+            now = time.monotonic()
+            remaining = deadline - now
+            if remaining <= 0:
+                break
+            if sends < _SSDP_SEND_COUNT:
+                if now >= next_send_ts:
+                    try:
+                        sock.sendto(payload, _SSDP_ADDR)
+                    except OSError:
+                        pass
+                    sends += 1
+                    next_send_ts += _SSDP_RESEND_INTERVAL_S
+                    continue
+                wait = min(remaining, next_send_ts - now)
+            else:
+                wait = remaining
+            if not sel.select(timeout=wait):
+                continue
             try:
                 data, addr = sock.recvfrom(8192)
-            except socket.timeout:
+            except BlockingIOError:
                 continue
             except OSError:
                 break
-            headers = _parse_ssdp_response(data)
             # addr[0] is usually the device IP; location may contain the same.
             ip = addr[0]
             try:
                 ip = _safe_ip(ip)
             except ValueError:
                 continue
+            if ip in ips:
+                continue
+            headers = _parse_ssdp_response(data)
             if headers.get("st", "").lower() != "roku:ecp":
                 continue
             ips.add(ip)
     finally:
+        sel.close()
         sock.close()
 
-    devices: list[RokuDevice] = []
-    for ip in sorted(ips, key=lambda s: ipaddress.ip_address(s)):
-        if not fetch_device_info:
-            devices.append(RokuDevice(ip=ip))
-            continue
+    # SSDP runs over AF_INET, so every collected address is dotted-quad IPv4.
+    ordered = sorted(ips, key=lambda s: tuple(int(x) for x in s.split(".")))
+    if not fetch_device_info or not ordered:
+        return [RokuDevice(ip=ip) for ip in ordered]
+
+    def _fetch(ip: str) -> RokuDevice:
         try:
-            devices.append(Roku(ip, timeout_s=info_timeout_s).get_device_info())
+            return Roku(ip, timeout_s=info_timeout_s).get_device_info_cached()
         except Exception:
-            devices.append(RokuDevice(ip=ip))
-    return devices
+            return RokuDevice(ip=ip)
+
+    with ThreadPoolExecutor(max_workers=min(8, len(ordered))) as ex:
+        return list(ex.map(_fetch, ordered))
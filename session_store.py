@@ -1,13 +1,23 @@
 from __future__ import annotations
 
+import bisect
+import datetime
 import hashlib
-import json
-import os
-import tempfile
+import itertools
+import sqlite3
+import threading
 import time
 import typing as t
+from collections import OrderedDict, deque
 from pathlib import Path
 
+from state_db import dumps, loads, open_state_db
+
+
+MAX_SESSIONS = 500
+# Window indexes kept in memory; cookie-less clients mint a new user id on every request.
+WINDOW_CACHE_SIZE = 256
+
 
 def _now_ts() -> float:
     return time.time()
@@ -18,14 +28,51 @@ def _iso(ts: float) -> str:
 
 
 def _parse_iso(s: str) -> float:
-    return time.mktime(time.strptime(s, "%Y-%m-%dT%H:%M:%S"))
+    # Naive local time, matching what `_iso` writes.
+    return datetime.datetime.fromisoformat(s).timestamp()
+
+
+def _json_default(obj: t.Any) -> t.Any:
+    # User session history is held in a bounded deque while in memory.
+    if isinstance(obj, deque):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _save_users(conn: sqlite3.Connection, ip: str, users: dict[str, t.Any]) -> None:
+    # One row per (ip, user_id); other users of the device are left untouched.
+    conn.executemany(
+        "INSERT OR REPLACE INTO session_users (ip, user_id, state) VALUES (?, ?, ?)",
+        [(ip, user_id, dumps(user, default=_json_default)) for user_id, user in users.items()],
+    )
+
 
+def _import_json_state(conn: sqlite3.Connection, state: dict[str, t.Any]) -> None:
+    users = state.get("users")
+    if isinstance(users, dict):
+        _save_users(conn, str(state["device_ip"]), users)
 
-def _safe_device_key(ip: str) -> str:
-    return ip.replace(":", "_")
+
+def _start_ts_of(entry: dict[str, t.Any]) -> t.Optional[int]:
+    # Epoch seconds are stored next to the display ISO string; records written before that
+    # are migrated on first read (and persisted by the next save).
+    st = entry.get("start_ts")
+    if isinstance(st, int):
+        return st
+    try:
+        st = int(_parse_iso(t.cast(str, entry.get("start_time"))))
+    except Exception:
+        return None
+    entry["start_ts"] = st
+    return st
 
 
 def make_user_id(device_key: str, browser_id: str) -> str:
+    return "u_" + hashlib.blake2b(f"{device_key}|{browser_id}".encode("utf-8"), digest_size=8).hexdigest()
+
+
+def _legacy_user_id(device_key: str, browser_id: str) -> str:
+    # Ids written before the switch to BLAKE2b; only used to migrate existing records.
     h = hashlib.sha256(f"{device_key}|{browser_id}".encode("utf-8")).hexdigest()
     return "u_" + h[:16]
 
@@ -33,44 +80,61 @@ def make_user_id(device_key: str, browser_id: str) -> str:
 class SessionStore:
     def __init__(self, root_dir: Path):
         self.root_dir = root_dir
-        self.sessions_dir = self.root_dir / "sessions"
-        self.sessions_dir.mkdir(parents=True, exist_ok=True)
-
-    def _path_for_ip(self, ip: str) -> Path:
-        return self.sessions_dir / f"{_safe_device_key(ip)}.json"
+        self._db = open_state_db(root_dir)
+        self._db.migrate_json_dir("migrated_json_sessions", self.root_dir / "sessions", _import_json_state)
+        # (ip, user_id) -> (token, ascending start_ts, prefix sums of duration_sec) for window totals.
+        self._window_cache: OrderedDict[tuple[str, str], tuple[tuple[t.Any, ...], list[int], list[int]]] = OrderedDict()
+        self._lock = threading.Lock()
 
     def load(self, ip: str) -> dict[str, t.Any]:
-        path = self._path_for_ip(ip)
-        if not path.exists():
-            return {"device_ip": ip, "users": {}}
-        try:
-            return json.loads(path.read_text(encoding="utf-8"))
-        except Exception:
-            return {"device_ip": ip, "users": {}}
+        with self._db.connection() as conn:
+            rows = conn.execute("SELECT user_id, state FROM session_users WHERE ip = ?", (ip,)).fetchall()
+        users: dict[str, t.Any] = {}
+        for user_id, blob in rows:
+            try:
+                users[user_id] = loads(blob)
+            except Exception:
+                continue
+        return {"device_ip": ip, "users": users}
 
     def save(self, ip: str, state: dict[str, t.Any]) -> None:
-        path = self._path_for_ip(ip)
-        state = dict(state)
-        state["device_ip"] = ip
-
-        tmp_fd, tmp_path = tempfile.mkstemp(prefix=path.stem + ".", suffix=".tmp", dir=str(self.sessions_dir))
+        if state.get("device_ip") != ip:
+            state["device_ip"] = ip
+        users = state.get("users")
+        with self._db.transaction() as conn:
+            _save_users(conn, ip, users if isinstance(users, dict) else {})
+
+    def _load_user(self, ip: str, user_id: str) -> t.Optional[dict[str, t.Any]]:
+        with self._db.connection() as conn:
+            row = conn.execute(
+                "SELECT state FROM session_users WHERE ip = ? AND user_id = ?", (ip, user_id)
+            ).fetchone()
+        if row is None:
+            return None
         try:
-            with os.fdopen(tmp_fd, "w", encoding="utf-8", newline="\n") as f:
-                json.dump(state, f, indent=2, sort_keys=True)
-                f.write("\n")
-            os.replace(tmp_path, path)
-        finally:
-            try:
-                os.unlink(tmp_path)
-            except OSError:
-                pass
-
-    def _get_user(self, state: dict[str, t.Any], ip: str, browser_id: str) -> tuple[str, dict[str, t.Any]]:
-        users: dict[str, t.Any] = state.setdefault("users", {})
+            user = loads(row[0])
+        except Exception:
+            return None
+        return user if isinstance(user, dict) else None
+
+    def _save_user(self, ip: str, browser_id: str, user_id: str, user: dict[str, t.Any], created: bool) -> None:
+        with self._db.transaction() as conn:
+            if created:
+                # A record found under its legacy SHA-256 id moves to the new id.
+                conn.execute(
+                    "DELETE FROM session_users WHERE ip = ? AND user_id = ?", (ip, _legacy_user_id(ip, browser_id))
+                )
+            _save_users(conn, ip, {user_id: user})
+
+    def _get_user(self, ip: str, browser_id: str) -> tuple[str, dict[str, t.Any], bool]:
+        # Read-only; `changed` means the record is new or migrated and still has to be saved.
         device_key = ip
         user_id = make_user_id(device_key, browser_id)
-        user = users.get(user_id)
-        if not isinstance(user, dict):
+        user = self._load_user(ip, user_id)
+        changed = user is None
+        if changed:
+            user = self._load_user(ip, _legacy_user_id(device_key, browser_id))
+        if user is None:
             user = {
                 "browser_id": browser_id,
                 "sessions": [],
@@ -79,14 +143,28 @@ class SessionStore:
                 "last_active_app_id": None,
                 "updated_ts": None,
             }
-            users[user_id] = user
-        user["browser_id"] = browser_id
-        return user_id, user
+        if user.get("browser_id") != browser_id:
+            user["browser_id"] = browser_id
+        sessions = user.get("sessions")
+        if not isinstance(sessions, deque):
+            # Stored newest first, so keep the head of an over-long list.
+            user["sessions"] = deque(
+                itertools.islice(sessions if isinstance(sessions, list) else [], MAX_SESSIONS), maxlen=MAX_SESSIONS
+            )
+        return user_id, user, changed
 
     def observe_active_app(self, ip: str, browser_id: str, active_app: t.Optional[dict[str, t.Any]]) -> dict[str, t.Any]:
+        with self._db.transaction():
+            return self._observe_active_app(ip, browser_id, active_app)
+
+    def _observe_active_app(
+        self,
+        ip: str,
+        browser_id: str,
+        active_app: t.Optional[dict[str, t.Any]],
+    ) -> dict[str, t.Any]:
         ts = _now_ts()
-        state = self.load(ip)
-        user_id, user = self._get_user(state, ip, browser_id)
+        user_id, user, created = self._get_user(ip, browser_id)
 
         active_id = None
         active_name = None
@@ -101,23 +179,20 @@ class SessionStore:
             cur = user.get("current")
             if not isinstance(cur, dict):
                 return
-            start_time = t.cast(str, cur.get("start_time"))
-            try:
-                start_ts = _parse_iso(start_time)
-            except Exception:
-                start_ts = end_ts
-            duration = max(0, int(end_ts - start_ts))
+            start_ts = _start_ts_of(cur)
+            if start_ts is None:
+                start_ts = int(end_ts)
+            duration = max(0, int(end_ts) - start_ts)
             session = {
                 "channel_id": cur.get("channel_id"),
                 "channel_name": cur.get("channel_name"),
-                "start_time": start_time,
+                "start_time": cur.get("start_time") or _iso(start_ts),
                 "end_time": _iso(end_ts),
+                "start_ts": start_ts,
+                "end_ts": int(end_ts),
                 "duration_sec": duration,
             }
-            sessions = user.setdefault("sessions", [])
-            if isinstance(sessions, list):
-                sessions.insert(0, session)
-                del sessions[500:]
+            user["sessions"].appendleft(session)
             user["total_watch_time_sec"] = int(user.get("total_watch_time_sec") or 0) + duration
             user["current"] = None
 
@@ -126,6 +201,7 @@ class SessionStore:
                 "channel_id": active_id,
                 "channel_name": active_name,
                 "start_time": _iso(start_ts),
+                "start_ts": int(start_ts),
             }
 
         if active_id is None:
@@ -138,46 +214,65 @@ class SessionStore:
 
         user["last_active_app_id"] = active_id
         user["updated_ts"] = _iso(ts)
-        self.save(ip, state)
+        self._save_user(ip, browser_id, user_id, user, created)
 
         return {"device_ip": ip, "user_id": user_id}
 
-    def get_user_view(self, ip: str, browser_id: str) -> dict[str, t.Any]:
-        state = self.load(ip)
-        user_id, user = self._get_user(state, ip, browser_id)
-        self.save(ip, state)
+    def _window_index(self, ip: str, user_id: str, sessions: deque[dict[str, t.Any]]) -> tuple[list[int], list[int]]:
+        # Sessions are only ever prepended (newest first), so length plus the head record identify
+        # the list well enough to reuse the index between polls.
+        head = sessions[0] if sessions else {}
+        token = (len(sessions), head.get("start_time"), head.get("end_time"), head.get("duration_sec"))
+        key = (ip, user_id)
+        with self._lock:
+            hit = self._window_cache.get(key)
+            if hit is not None and hit[0] == token:
+                self._window_cache.move_to_end(key)
+                return hit[1], hit[2]
+
+        pairs: list[tuple[int, int]] = []
+        for sess in sessions:
+            st = _start_ts_of(sess)
+            if st is not None:
+                pairs.append((st, int(sess.get("duration_sec") or 0)))
+        pairs.sort()
+        starts = [st for st, _ in pairs]
+        cum = [0, *itertools.accumulate(dur for _, dur in pairs)]
+        with self._lock:
+            self._window_cache[key] = (token, starts, cum)
+            self._window_cache.move_to_end(key)
+            while len(self._window_cache) > WINDOW_CACHE_SIZE:
+                self._window_cache.popitem(last=False)
+        return starts, cum
 
-        sessions = user.get("sessions") if isinstance(user.get("sessions"), list) else []
+    def get_user_view(self, ip: str, browser_id: str) -> dict[str, t.Any]:
+        user_id, user, changed = self._get_user(ip, browser_id)
+        if changed:
+            # Re-read under the write lock so a concurrent poller's record is not overwritten.
+            with self._db.transaction():
+                user_id, user, changed = self._get_user(ip, browser_id)
+                if changed:
+                    self._save_user(ip, browser_id, user_id, user, changed)
+
+        sessions: deque[dict[str, t.Any]] = user["sessions"]
         current = user.get("current") if isinstance(user.get("current"), dict) else None
         total = int(user.get("total_watch_time_sec") or 0)
         now_ts = _now_ts()
 
-        def window_start_ts(days_back: int) -> float:
-            lt = time.localtime(now_ts)
-            midnight = time.mktime((lt.tm_year, lt.tm_mon, lt.tm_mday, 0, 0, 0, lt.tm_wday, lt.tm_yday, lt.tm_isdst))
-            return midnight - (days_back * 86400)
-
-        today_start = window_start_ts(0)
-        week_start = window_start_ts(6)
-        month_start = window_start_ts(29)
-
-        def sum_since(start_ts: float) -> int:
-            acc = 0
-            for s in sessions:
-                try:
-                    st = _parse_iso(t.cast(str, s.get("start_time")))
-                except Exception:
-                    continue
-                if st < start_ts:
-                    continue
-                acc += int(s.get("duration_sec") or 0)
+        lt = time.localtime(now_ts)
+        midnight = int(time.mktime((lt.tm_year, lt.tm_mon, lt.tm_mday, 0, 0, 0, lt.tm_wday, lt.tm_yday, lt.tm_isdst)))
+        today_start = midnight
+        week_start = midnight - 6 * 86400
+        month_start = midnight - 29 * 86400
+
+        starts, cum = self._window_index(ip, user_id, sessions)
+
+        def sum_since(start_ts: int) -> int:
+            acc = cum[-1] - cum[bisect.bisect_left(starts, start_ts)]
             if current:
-                try:
-                    st = _parse_iso(t.cast(str, current.get("start_time")))
-                    if st >= start_ts:
-                        acc += max(0, int(now_ts - st))
-                except Exception:
-                    pass
+                st = _start_ts_of(current)
+                if st is not None and st >= start_ts:
+                    acc += max(0, int(now_ts) - st)
             return acc
 
         return {
@@ -191,7 +286,7 @@ class SessionStore:
                 "month_sec": sum_since(month_start),
             },
             "current": current,
-            "sessions": sessions[:100],
+            "sessions": list(itertools.islice(sessions, 100)),
             "updated_ts": user.get("updated_ts"),
         }
 
@@ -206,9 +301,7 @@ class SessionStore:
         current = t.cast(t.Optional[dict[str, t.Any]], view.get("current"))
         if current and current.get("channel_id") and current.get("start_time"):
             cid = str(current.get("channel_id"))
-            try:
-                start_ts = _parse_iso(t.cast(str, current.get("start_time")))
-                totals[cid] = totals.get(cid, 0) + max(0, int(_now_ts() - start_ts))
-            except Exception:
-                pass
+            start_ts = _start_ts_of(current)
+            if start_ts is not None:
+                totals[cid] = totals.get(cid, 0) + max(0, int(_now_ts()) - start_ts)
         return totals
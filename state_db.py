@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import contextlib
+import json
+import sqlite3
+import threading
+import typing as t
+from functools import lru_cache
+from pathlib import Path
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+
+
+DB_NAME = "devices.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    ip TEXT PRIMARY KEY,
+    state BLOB NOT NULL,
+    device_name TEXT,
+    device_model TEXT,
+    last_seen_ts TEXT,
+    last_reachable_ts TEXT
+);
+CREATE INDEX IF NOT EXISTS devices_last_seen ON devices (last_seen_ts, ip);
+CREATE TABLE IF NOT EXISTS session_users (
+    ip TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    state BLOB NOT NULL,
+    PRIMARY KEY (ip, user_id)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def dumps(obj: t.Any, default: t.Optional[t.Callable[[t.Any], t.Any]] = None) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, default=default)
+    return json.dumps(obj, default=default, separators=(",", ":")).encode("utf-8")
+
+
+def loads(data: t.Union[bytes, str]) -> t.Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# Single SQLite file (WAL mode) backing both DeviceStore and SessionStore.
+class StateDB:
+    def __init__(self, path: Path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # One connection shared by the Flask worker threads; every use goes through the lock.
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._lock = threading.RLock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+
+    @contextlib.contextmanager
+    def connection(self) -> t.Iterator[sqlite3.Connection]:
+        with self._lock:
+            yield self._conn
+
+    @contextlib.contextmanager
+    def transaction(self) -> t.Iterator[sqlite3.Connection]:
+        # Re-entrant: a nested transaction() joins the outer one, so load/modify/save helpers
+        # can be composed into a single commit.
+        with self._lock:
+            if self._conn.in_transaction:
+                yield self._conn
+                return
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def migrate_json_dir(
+        self,
+        key: str,
+        json_dir: Path,
+        import_state: t.Callable[[sqlite3.Connection, dict[str, t.Any]], None],
+    ) -> None:
+        # Imports the legacy one-file-per-device JSON state once; the files are left in place.
+        with self.transaction() as conn:
+            if conn.execute("SELECT 1 FROM meta WHERE key = ?", (key,)).fetchone():
+                return
+            if json_dir.is_dir():
+                for path in sorted(json_dir.glob("*.json"), key=lambda p: p.name):
+                    try:
+                        state = loads(path.read_bytes())
+                    except Exception:
+                        continue
+                    if isinstance(state, dict) and state.get("device_ip"):
+                        import_state(conn, state)
+            conn.execute("INSERT INTO meta (key, value) VALUES (?, ?)", (key, "1"))
+
+
+@lru_cache(maxsize=8)
+def _open(path: str) -> StateDB:
+    return StateDB(Path(path))
+
+
+def open_state_db(root_dir: Path) -> StateDB:
+    # Both stores built on the same data root share one connection.
+    return _open(str((root_dir / DB_NAME).resolve()))